@@ -1,16 +1,20 @@
-import os, json, logging, base64, hashlib, hmac, time, secrets
-from datetime import datetime, timezone
+import os, logging, base64, hashlib, hmac, time, secrets, threading, functools, asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 from typing import Dict, Any, Optional, List
 from urllib.parse import quote
 
-from fastapi import FastAPI, Request, HTTPException, Query
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi import FastAPI, Request, Response, HTTPException, Query, BackgroundTasks
+from fastapi.responses import ORJSONResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 
-import stripe
-import firebase_admin
-from firebase_admin import credentials, firestore
+import orjson
+# stripe / firebase_admin / google-cloud-firestore are imported on first use
+# (_stripe, get_db and function-local imports) to keep worker cold starts and
+# /health off their import cost.
 
 # ------------------ Logging ------------------
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
@@ -18,71 +22,224 @@ logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s | %(levelname)s | %(nam
 log = logging.getLogger("picklepot-fastapi")
 
 # ------------------ Env ------------------
-stripe.api_key = os.environ["STRIPE_SECRET_KEY"]
+STRIPE_SECRET_KEY = os.environ["STRIPE_SECRET_KEY"]
+STRIPE_TIMEOUT_SECONDS = int(os.getenv("STRIPE_TIMEOUT", "20"))  # per API call; sdk default is 80
+# Threads for sync handlers (Firestore/Stripe I/O); anyio's default is 40
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+# keep-alive connections to api.stripe.com; one per handler thread by default
+STRIPE_POOL_SIZE = int(os.getenv("STRIPE_POOL_SIZE") or THREADPOOL_SIZE)
 WEBHOOK_SECRET = os.environ["STRIPE_WEBHOOK_SECRET"]
 FRONTEND_BASE_URL = os.getenv("FRONTEND_BASE_URL", "https://picklepotters.netlify.app")
 OWNER_TOKEN_SECRET = os.getenv("OWNER_TOKEN_SECRET", "CHANGE-ME")  # set strong value
 POT_CREATE_PRICE_CENT = int(os.getenv("POT_CREATE_PRICE_CENT", "1000"))
 CORS_ALLOW = os.getenv("CORS_ALLOW") or os.getenv("CORS_ORIGINS") or "*"
 
+# Warm Firestore/Stripe connections in the background at startup
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "1") == "1"
+
+# Threads reserved for applying webhook events (see _webhook_executor)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+
+# Max pots one create-pot checkout can mint
+MAX_POTS_PER_SESSION = 20
+
+# Drafts and checkout session maps carry expireAt = now + this; a Firestore TTL
+# policy (firestore.indexes.json) reaps the ones abandoned mid-checkout.
+# Must outlive a Stripe Checkout Session (24h) plus Stripe's 3-day webhook retry
+# window, so a late completed event still finds its draft and session map.
+CHECKOUT_STATE_TTL_SECONDS = int(os.getenv("CHECKOUT_STATE_TTL", str(5 * 24 * 3600)))
+
 # Owner code TTL (plaintext exposure on /create-status)
 OWNER_CODE_TTL_SECONDS = int(os.getenv("OWNER_CODE_TTL", "600"))  # 10 minutes default
 
 # Firebase
 cred_json = os.environ["FIREBASE_SERVICE_ACCOUNT_JSON"]
 fb_project = os.getenv("FIRESTORE_PROJECT_ID")
-cred = credentials.Certificate(json.loads(cred_json))
-if not firebase_admin._apps:
-    if fb_project:
-        firebase_admin.initialize_app(cred, {"projectId": fb_project})
-    else:
-        firebase_admin.initialize_app(cred)
-db = firestore.client()
+_db = None
+_db_lock = threading.Lock()
+
+def get_db():
+    """Firestore client, initialised on first call (thread-safe)."""
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                import firebase_admin
+                from firebase_admin import credentials, firestore
+                cred = credentials.Certificate(orjson.loads(cred_json))
+                if not firebase_admin._apps:
+                    if fb_project:
+                        firebase_admin.initialize_app(cred, {"projectId": fb_project})
+                    else:
+                        firebase_admin.initialize_app(cred)
+                _db = firestore.client()
+    return _db
+
+@functools.lru_cache(maxsize=None)
+def _stripe():
+    import requests
+    import stripe
+    stripe.api_key = STRIPE_SECRET_KEY
+    stripe.max_network_retries = 2
+    # One keep-alive requests.Session shared by every threadpool worker (stripe's
+    # default is a session per thread), so API calls reuse warm TLS connections.
+    # requests keeps only 10 idle connections per host by default; size the pool
+    # to the threadpool so concurrent calls don't churn handshakes.
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4,
+                                                            pool_maxsize=STRIPE_POOL_SIZE))
+    stripe.default_http_client = stripe.RequestsClient(timeout=STRIPE_TIMEOUT_SECONDS,
+                                                       session=session)
+    return stripe
 
 # ------------------ Helpers ------------------
 def utcnow():
     return datetime.now(timezone.utc)
 
+def checkout_state_expiry():
+    return utcnow() + timedelta(seconds=CHECKOUT_STATE_TTL_SECONDS)
+
 def server_base(request: Request) -> str:
     return f"{request.url.scheme}://{request.headers.get('host')}"
 
+CHECKOUT_CURRENCY = "usd"
+
+def _is_abs_http(u: str) -> bool:
+    return isinstance(u, str) and u.startswith(("http://", "https://"))
+
+def _line_items(name: str, unit_amount: int, quantity: int = 1) -> list:
+    # Checkout line_items for a single ad-hoc price; only name/amount/qty vary
+    return [{
+        "price_data": {"currency": CHECKOUT_CURRENCY, "product_data": {"name": name}, "unit_amount": unit_amount},
+        "quantity": quantity,
+    }]
+
 def b64url_encode(b: bytes) -> str:
-    return base64.urlsafe_b64encode(b).decode().rstrip("=")
+    return base64.urlsafe_b64encode(b).rstrip(b"=").decode("ascii")
 
 def b64url_decode(s: str) -> bytes:
     return base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
 
+_OWNER_CODE_TRANS = bytes.maketrans(b"OI", b"89")  # avoid O/0 and I/1 confusion
+
+def owner_code_from_bytes(raw: bytes) -> str:
+    return base64.b32encode(raw).rstrip(b"=").translate(_OWNER_CODE_TRANS).decode("ascii")
+
 def random_owner_code(length_bytes: int = 5) -> str:
-    code = base64.b32encode(secrets.token_bytes(length_bytes)).decode().rstrip("=")
-    return code.replace("O","8").replace("I","9")
+    return owner_code_from_bytes(secrets.token_bytes(length_bytes))
 
-def hash_code(code: str) -> str:
-    return hashlib.sha256(("pp_salt_"+code).encode()).hexdigest()
+# sha256 state with the fixed "pp_salt_" prefix already absorbed; hash_code copies it
+_CODE_HASH_BASE = hashlib.sha256(b"pp_salt_")
 
-def _pot_token_salt(pot_id: str) -> str:
-    snap = db.collection("pots").document(pot_id).get()
+def hash_code(code: str) -> str:
+    h = _CODE_HASH_BASE.copy()
+    h.update(code.encode())
+    return h.hexdigest()
+
+def _pot_token_salt(pot_id: str, fresh: bool = False) -> str:
+    # cached for SALT_CACHE_TTL_SECONDS; verify_owner_token passes fresh=True
+    if not fresh:
+        salt = _token_salt_cache.get(pot_id)
+        if salt is not None:
+            return salt
+    snap = get_db().collection("pots").document(pot_id).get(field_paths=["owner_token_salt"])
     data = snap.to_dict() if snap.exists else {}
-    return (data or {}).get("owner_token_salt", "")
-
-def make_owner_token(pot_id: str) -> str:
-    ts = int(time.time())
-    payload = f"{pot_id}.{ts}"
-    key = (OWNER_TOKEN_SECRET + "|" + _pot_token_salt(pot_id)).encode()
-    mac = hmac.new(key, payload.encode(), hashlib.sha256).digest()[:16]
-    return f"{b64url_encode(payload.encode())}.{b64url_encode(mac)}"
+    salt = (data or {}).get("owner_token_salt", "")
+    if salt:
+        _token_salt_cache.set(pot_id, salt)
+    return salt
+
+# Owner-token MAC key is OWNER_TOKEN_SECRET|salt; the secret half is encoded once.
+_OWNER_KEY_PREFIX = (OWNER_TOKEN_SECRET + "|").encode()
+
+@functools.lru_cache(maxsize=4096)
+def _owner_hmac(salt: str):
+    # keyed by salt, so a rotated salt simply gets a fresh entry
+    return hmac.new(_OWNER_KEY_PREFIX + salt.encode(), digestmod=hashlib.sha256)
+
+def _owner_mac(salt: str, payload: bytes) -> bytes:
+    h = _owner_hmac(salt).copy()
+    h.update(payload)
+    return h.digest()[:16]
+
+def make_owner_token(pot_id: str, salt: Optional[str] = None) -> str:
+    # pass `salt` when the caller already holds it (e.g. not yet committed)
+    if salt is None:
+        salt = _pot_token_salt(pot_id)
+    payload = f"{pot_id}.{int(time.time())}".encode()
+    return f"{b64url_encode(payload)}.{b64url_encode(_owner_mac(salt, payload))}"
 
 def verify_owner_token(pot_id: str, token: str) -> bool:
+    # always against the stored salt: rotate-link is how a leaked link is revoked,
+    # so a cached salt must never keep an old link valid
+    p_b64, sep, mac_b64 = token.partition(".")
+    if not sep or "." in mac_b64:
+        return False
     try:
-        p_b64, mac_b64 = token.split(".")
-        payload = b64url_decode(p_b64).decode()
-        pot, ts_s = payload.split(".")
-        if pot != pot_id: return False
+        payload = b64url_decode(p_b64)
         mac = b64url_decode(mac_b64)
-        key = (OWNER_TOKEN_SECRET + "|" + _pot_token_salt(pot_id)).encode()
-        exp = hmac.new(key, payload.encode(), hashlib.sha256).digest()[:16]
-        return hmac.compare_digest(mac, exp)
-    except Exception:
+    except ValueError:
+        return False
+    pot, sep, _ = payload.partition(b".")
+    if not sep or pot != pot_id.encode():
         return False
+    return hmac.compare_digest(mac, _owner_mac(_pot_token_salt(pot_id, fresh=True), payload))
+
+class TTLCache:
+    """Process-local LRU with per-entry expiry; safe to share across threadpool workers."""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+# pot_id -> owner_token_salt for make_owner_token only; verify_owner_token
+# always reads the stored salt. rotate-link updates the entry in place.
+SALT_CACHE_TTL_SECONDS = int(os.getenv("SALT_CACHE_TTL", "60"))
+_token_salt_cache = TTLCache(10_000, SALT_CACHE_TTL_SECONDS)
+
+FIRESTORE_BATCH_LIMIT = 500  # max writes per WriteBatch / transaction commit
+
+def _apply_writes(writer, writes: List[tuple]):
+    """Queue (ref, data) pairs on a WriteBatch/Transaction as merge-sets; data=None deletes."""
+    for ref, data in writes:
+        if data is None:
+            writer.delete(ref)
+        else:
+            writer.set(ref, data, merge=True)
+
+def _commit_writes(writes: List[tuple]):
+    """Commit (ref, data) pairs in as few batches as possible."""
+    for i in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+        batch = get_db().batch()
+        _apply_writes(batch, writes[i:i + FIRESTORE_BATCH_LIMIT])
+        batch.commit()
+
+# Every field _public_pot_dict reads; listing queries project to just these.
+_PUBLIC_POT_FIELDS = ["status", "name", "event_name", "tournament_name", "location", "city",
+                      "member_buy_in", "buy_in", "createdAt"]
 
 def _public_pot_dict(doc_id: str, data: dict) -> dict:
     # expose only fields useful for listing & joining
@@ -107,35 +264,44 @@ def _matches_query(p: dict, q: str) -> bool:
     return False
 
 # ------------------ FastAPI ------------------
-app = FastAPI(title="PicklePot Backend")
-
-# ---- CORS (explicit origins; handles preflight) ----
-from fastapi.middleware.cors import CORSMiddleware
-
-# Prefer env list (comma-separated) or fall back to dev + FRONTEND_BASE_URL
-_env = os.getenv("CORS_ALLOW") or os.getenv("CORS_ORIGINS")
-_default_frontend = os.getenv("FRONTEND_BASE_URL", "https://picklepotters.netlify.app")
-_origins = [o.strip() for o in (_env.split(",") if _env else []) if o.strip()]
-if not _origins:
-    _origins = ["http://localhost:5173", _default_frontend]
+def _warm_up():
+    # pay the Firebase/Stripe imports, client init and first gRPC/TLS connects
+    # before the first real request does
+    try:
+        get_db().collection("pot_drafts").limit(1).get()
+        _stripe().Balance.retrieve()
+    except Exception as e:
+        log.warning("warmup_error", extra={"error": str(e)})
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    import anyio.to_thread
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    # off-thread, so startup and /health don't wait on it
+    if WARMUP_ON_START:
+        threading.Thread(target=_warm_up, name="warmup", daemon=True).start()
+    yield
+
+app = FastAPI(title="PicklePot Backend", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# ---- CORS ----
+# CORS_ALLOW / CORS_ORIGINS: comma-separated origins, or "*" (default).
+# A plain "*" takes Starlette's allow-all fast path; an explicit allowlist is
+# handed over as a frozenset so the per-request origin check is a hash lookup.
+# CORS_ALLOW_REGEX optionally admits e.g. Netlify deploy previews as well.
+# Credentials stay off for every origin setting: the API authenticates with
+# owner keys/codes in the body, never cookies.
+_cors_origins = frozenset(o.strip() for o in CORS_ALLOW.split(",") if o.strip()) or frozenset({"*"})
+_cors_allow_all = "*" in _cors_origins
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=_origins,
-    allow_credentials=False,                   # set True only if you actually use cookies/auth
-    allow_methods=["GET", "POST", "OPTIONS"],
-    allow_headers=["Content-Type", "Authorization"],
+    allow_origins=["*"] if _cors_allow_all else _cors_origins,
+    allow_origin_regex=os.getenv("CORS_ALLOW_REGEX") or None,
+    allow_credentials=False,  # set True only if you actually use cookies/auth
+    allow_methods=["GET", "POST", "OPTIONS"], allow_headers=["*"],
     expose_headers=["*"],
 )
-# -----------------------------------------------
-
-
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"] if (CORS_ALLOW == "*" or not CORS_ALLOW) else [o.strip() for o in CORS_ALLOW.split(",") if o.strip()],
-    allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
-)
 
 @app.get("/", include_in_schema=False)
 def root():
@@ -148,94 +314,143 @@ def health():
 # ------------------ Public list/search of Active Tournaments ------------------
 @app.get("/pots")
 def list_pots(q: Optional[str] = Query(None, description="search text"),
-              limit: int = Query(50, ge=1, le=200)):
+              limit: int = Query(50, ge=1, le=200),
+              cursor: Optional[str] = Query(None, description="next_cursor from the previous page")):
     """Public endpoint: list active pots for browsing/joining. Anyone can call this."""
-    try:
-        # Query active pots; order by createdAt desc if present
-        pots = []
-        query = db.collection("pots").where("status", "==", "active")
-        # Try to order by createdAt if indexed, otherwise fallback unordered
-        try:
-            stream = query.order_by("createdAt", direction=firestore.Query.DESCENDING).limit(limit*2).stream()
-        except Exception:
-            stream = query.limit(limit*2).stream()
-        for d in stream:
-            data = d.to_dict() or {}
-            public = _public_pot_dict(d.id, data)
+    from firebase_admin import firestore
+    from google.api_core.exceptions import FailedPrecondition
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    after = None
+    # only a text filter needs to over-fetch; otherwise every scanned pot is returned
+    page = limit * 2 if q else limit
+
+    def _scan(query):
+        if after is not None:
+            query = query.start_after(after)
+        pots, last_id, scanned = [], None, 0
+        append = pots.append
+        for d in query.limit(page).stream():
+            scanned += 1
+            last_id = d.id
+            public = _public_pot_dict(d.id, d.to_dict() or {})
             if _matches_query(public, q):
-                pots.append(public)
+                append(public)
             if len(pots) >= limit:
                 break
-        return {"ok": True, "pots": pots, "count": len(pots)}
+        # resume after the last pot scanned, not the last returned, so filtered-out
+        # pots aren't read again; a short page means there is nothing left
+        more = len(pots) >= limit or scanned >= page
+        return pots, (last_id if more else None)
+
+    try:
+        if cursor:
+            try:
+                cursor_ref = get_db().collection("pots").document(cursor)
+            except ValueError:  # e.g. "a/b" is not a single document id
+                raise HTTPException(400, "Invalid cursor")
+            after = cursor_ref.get(field_paths=["createdAt"])
+            if not after.exists:
+                raise HTTPException(400, "Invalid cursor")
+        query = (get_db().collection("pots")
+                 .where(filter=FieldFilter("status", "==", "active"))
+                 .select(_PUBLIC_POT_FIELDS))
+
+        try:
+            pots, next_cursor = _scan(query.order_by("createdAt", direction=firestore.Query.DESCENDING))
+        except FailedPrecondition:
+            # composite index (firestore.indexes.json) not deployed yet: unordered
+            pots, next_cursor = _scan(query)
+        return {"ok": True, "pots": pots, "count": len(pots), "next_cursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
         log.error("list_pots_error", extra={"error": str(e)})
         raise HTTPException(500, "Failed to list active tournaments")
 
 # ------------------ Create-a-Pot ------------------
+# Shared by the request-body models: strip strings and ignore unknown keys in the
+# compiled validator instead of by hand in the handlers.
+_BODY_CONFIG = ConfigDict(extra="ignore", frozen=True, str_strip_whitespace=True)
+
 class CreatePotPayload(BaseModel):
+    model_config = _BODY_CONFIG
     draft: Dict[str, Any] | None = None
     success_url: str
     cancel_url: str
     amount_cents: Optional[int] = None
-    count: Optional[int] = 1
+    count: Optional[int] = Field(1, ge=1, le=MAX_POTS_PER_SESSION)
 
 @app.post("/create-pot-session")
-async def create_pot_session(payload: CreatePotPayload, request: Request):
+def create_pot_session(payload: CreatePotPayload, request: Request):
+    from firebase_admin import firestore
+    stripe = _stripe()
     draft = payload.draft or {}
     amount_cents = int(payload.amount_cents or POT_CREATE_PRICE_CENT)
-    count = max(1, int(payload.count or 1))
+    count = payload.count or 1
 
     if not payload.success_url or not payload.cancel_url:
         raise HTTPException(400, "Missing success/cancel URLs")
     if amount_cents < 50:
         raise HTTPException(400, "Minimum amount is 50 cents")
 
-    # stash the draft
-    draft_ref = db.collection("pot_drafts").document()
-    draft_ref.set({**draft, "status": "draft", "createdAt": utcnow()}, merge=True)
+    # the draft id is allocated client-side; the draft itself is written together
+    # with the session map once Stripe has accepted the session
+    draft_ref = get_db().collection("pot_drafts").document()
 
     session = stripe.checkout.Session.create(
         mode="payment",
-        line_items=[{
-            "price_data": {
-                "currency": "usd",
-                "product_data": {"name": f"Create Pot — {draft.get('name') or draft.get('tournament_name') or 'Tournament'}"},
-                "unit_amount": amount_cents,
-            },
-            "quantity": count,
-        }],
+        line_items=_line_items(f"Create Pot — {draft.get('name') or draft.get('tournament_name') or 'Tournament'}",
+                               amount_cents, count),
         success_url=f"{payload.success_url}?flow=create&session_id={{CHECKOUT_SESSION_ID}}",
         cancel_url=f"{server_base(request)}/cancel-create?session_id={{CHECKOUT_SESSION_ID}}&next={quote(payload.cancel_url)}",
         metadata={"draft_id": draft_ref.id, "flow": "create", "count": str(count)},
     )
 
-    db.collection("create_sessions").document(session["id"]).set({
-        "draft_id": draft_ref.id,
-        "count": count,
-        "createdAt": utcnow(),
-        "ready": False,
-    }, merge=True)
+    expire_at = checkout_state_expiry()
+    _commit_writes([
+        (draft_ref, {**draft, "status": "draft", "createdAt": firestore.SERVER_TIMESTAMP,
+                     "expireAt": expire_at}),
+        (get_db().collection("create_sessions").document(session["id"]), {
+            "draft_id": draft_ref.id,
+            "count": count,
+            "createdAt": firestore.SERVER_TIMESTAMP,
+            "expireAt": expire_at,
+            "ready": False,
+        }),
+    ])
 
     return {"draft_id": draft_ref.id, "url": session.url, "count": count}
 
-@app.get("/cancel-create")
-def cancel_create(session_id: str, next: str = "/"):
-    map_ref = db.collection("create_sessions").document(session_id)
-    snap = map_ref.get()
-    draft_id = (snap.to_dict() or {}).get("draft_id") if snap.exists else None
+def _cleanup_create_session(session_id: str):
+    map_ref = get_db().collection("create_sessions").document(session_id)
+    snap = map_ref.get(field_paths=["draft_id", "pots"])
+    m = (snap.to_dict() or {}) if snap.exists else {}
+    writes = []
+    draft_id = m.get("draft_id")
     if draft_id:
-        db.collection("pot_drafts").document(draft_id).delete()
-    # Remove any pots created under this session (belt and braces)
+        writes.append((get_db().collection("pot_drafts").document(draft_id), None))
+    # Remove any pots created under this session (belt and braces).
+    # create_sessions/{session_id} lists them, so delete by id instead of querying.
+    for p in m.get("pots") or []:
+        if p.get("pot_id"):
+            writes.append((get_db().collection("pots").document(p["pot_id"]), None))
+    writes.append((map_ref, None))
     try:
-        for pot_doc in db.collection("pots").where("stripe_session_id", "==", session_id).stream():
-            pot_doc.reference.delete()
+        _commit_writes(writes)
     except Exception as e:
         log.warning("cancel_create_session_cleanup_error", extra={"error": str(e)})
-    map_ref.delete()
+    _ready_status_cache.pop(session_id)
+
+@app.get("/cancel-create")
+def cancel_create(session_id: str, background_tasks: BackgroundTasks, next: str = "/"):
+    # redirect straight back; the draft/session cleanup runs after the response
+    background_tasks.add_task(_cleanup_create_session, session_id)
     return RedirectResponse(next, status_code=302)
 
 # ------------------ Join-a-Pot ------------------
 class JoinPayload(BaseModel):
+    model_config = _BODY_CONFIG
     pot_id: str
     entry_id: str
     amount_cents: int
@@ -246,7 +461,9 @@ class JoinPayload(BaseModel):
 
 
 @app.post("/create-checkout-session")
-async def create_checkout_session(payload: JoinPayload, request: Request):
+def create_checkout_session(payload: JoinPayload, request: Request):
+    from firebase_admin import firestore
+    stripe = _stripe()
     pot_id = payload.pot_id
     # Validate required fields
     if not pot_id or not payload.entry_id:
@@ -255,8 +472,6 @@ async def create_checkout_session(payload: JoinPayload, request: Request):
         raise HTTPException(400, "Minimum amount is 50 cents")
 
     # Validate absolute URLs for Stripe redirects
-    def _is_abs_http(u: str) -> bool:
-        return isinstance(u, str) and (u.startswith("http://") or u.startswith("https://"))
     if not _is_abs_http(payload.success_url):
         raise HTTPException(400, "Invalid success_url (must be absolute http/https)")
     if not _is_abs_http(payload.cancel_url):
@@ -265,14 +480,7 @@ async def create_checkout_session(payload: JoinPayload, request: Request):
     try:
         session = stripe.checkout.Session.create(
             mode="payment",
-            line_items=[{
-                "price_data": {
-                    "currency": "usd",
-                    "product_data": {"name": f"Join Pot — {payload.player_name or 'Player'}"},
-                    "unit_amount": int(payload.amount_cents),
-                },
-                "quantity": 1,
-            }],
+            line_items=_line_items(f"Join Pot — {payload.player_name or 'Player'}", int(payload.amount_cents)),
             customer_email=payload.player_email,
             success_url=f"{payload.success_url}?flow=join&session_id={{CHECKOUT_SESSION_ID}}&pot_id={pot_id}&entry_id={payload.entry_id}",
             cancel_url=f"{server_base(request)}/cancel-join?session_id={{CHECKOUT_SESSION_ID}}&pot_id={pot_id}&entry_id={payload.entry_id}&next={quote(payload.cancel_url)}",
@@ -284,10 +492,11 @@ async def create_checkout_session(payload: JoinPayload, request: Request):
             },
         )
 
-        db.collection("join_sessions").document(session["id"]).set({
+        get_db().collection("join_sessions").document(session["id"]).set({
             "pot_id": pot_id,
             "entry_id": (payload.entry_id or ""),
-            "createdAt": utcnow()
+            "createdAt": firestore.SERVER_TIMESTAMP,
+            "expireAt": checkout_state_expiry(),
         })
 
         return {"url": session.url, "session_id": session["id"]}
@@ -298,44 +507,20 @@ async def create_checkout_session(payload: JoinPayload, request: Request):
     except Exception as e:
         raise HTTPException(500, f"Server error creating checkout session: {e}")
 
-    pot_id = payload.pot_id
-    if not pot_id or not payload.entry_id:
-        raise HTTPException(400, "Missing pot_id or entry_id")
-    if payload.amount_cents < 50:
-        raise HTTPException(400, "Minimum amount is 50 cents")
-
-    session = stripe.checkout.Session.create(
-        mode="payment",
-        line_items=[{
-            "price_data": {
-                "currency": "usd",
-                "product_data": {"name": f"Join Pot — {payload.player_name or 'Player'}"},
-                "unit_amount": int(payload.amount_cents),
-            },
-            "quantity": 1,
-        }],
-        customer_email=payload.player_email,
-        success_url=f"{payload.success_url}?flow=join&session_id={{CHECKOUT_SESSION_ID}}&pot_id={pot_id}&entry_id={payload.entry_id}",
-        cancel_url=f"{server_base(request)}/cancel-join?session_id={{CHECKOUT_SESSION_ID}}&pot_id={pot_id}&entry_id={payload.entry_id}&next={quote(payload.cancel_url)}",
-        metadata={"flow": "join", "pot_id": pot_id, "entry_id": (payload.entry_id or ""), "player_email": payload.player_email or ""},
-    )
-
-    db.collection("join_sessions").document(session["id"]).set({"pot_id": pot_id,"entry_id": (payload.entry_id or ""),"createdAt": utcnow()})
-    return {"url": session.url, "session_id": session["id"]}
-
 @app.get("/cancel-join")
 def cancel_join(session_id: str, pot_id: Optional[str] = None, entry_id: Optional[str] = None, next: str = "/"):
-    map_ref = db.collection("join_sessions").document(session_id)
-    snap = map_ref.get()
-    if snap.exists:
-        m = snap.to_dict() or {}
-        pot_id = pot_id or m.get("pot_id")
-        entry_id = entry_id or m.get("entry_id")
-        map_ref.delete()
+    map_ref = get_db().collection("join_sessions").document(session_id)
+    if not (pot_id and entry_id):
+        snap = map_ref.get(field_paths=["pot_id", "entry_id"])
+        if snap.exists:
+            m = snap.to_dict() or {}
+            pot_id = pot_id or m.get("pot_id")
+            entry_id = entry_id or m.get("entry_id")
+    map_ref.delete()
 
     if pot_id and entry_id:
-        entry_ref = db.collection("pots").document(pot_id).collection("entries").document(entry_id)
-        es = entry_ref.get()
+        entry_ref = get_db().collection("pots").document(pot_id).collection("entries").document(entry_id)
+        es = entry_ref.get(field_paths=["paid"])
         if es.exists:
             entry = es.to_dict() or {}
             if not entry.get("paid"):
@@ -344,6 +529,7 @@ def cancel_join(session_id: str, pot_id: Optional[str] = None, entry_id: Optiona
 
 # ------------------ Owner auth / rotate ------------------
 class OwnerAuth(BaseModel):
+    model_config = _BODY_CONFIG
     key: Optional[str] = None
     code: Optional[str] = None
 
@@ -352,7 +538,7 @@ def _require_owner(pot_id: str, auth: OwnerAuth):
     if auth.key and verify_owner_token(pot_id, auth.key):
         return True
     if auth.code:
-        snap = db.collection("pots").document(pot_id).get()
+        snap = get_db().collection("pots").document(pot_id).get(field_paths=["owner_code_hash"])
         if not snap.exists: raise HTTPException(404, "Pot not found")
         if hash_code(auth.code) == (snap.to_dict() or {}).get("owner_code_hash"):
             return True
@@ -364,9 +550,10 @@ def owner_auth(pot_id: str, body: OwnerAuth):
 
 @app.post("/pots/{pot_id}/owner/rotate-code")
 def owner_rotate_code(pot_id: str, body: OwnerAuth):
+    from firebase_admin import firestore
     _require_owner(pot_id, body)
     code = random_owner_code()
-    db.collection("pots").document(pot_id).set({
+    get_db().collection("pots").document(pot_id).set({
         "owner_code_hash": hash_code(code),
         "owner_code_rotated_at": firestore.SERVER_TIMESTAMP,
     }, merge=True)
@@ -374,117 +561,240 @@ def owner_rotate_code(pot_id: str, body: OwnerAuth):
 
 @app.post("/pots/{pot_id}/owner/rotate-link")
 def owner_rotate_link(pot_id: str, body: OwnerAuth):
+    from firebase_admin import firestore
     _require_owner(pot_id, body)
     new_salt = b64url_encode(secrets.token_bytes(12))
-    db.collection("pots").document(pot_id).set({
+    get_db().collection("pots").document(pot_id).set({
         "owner_token_salt": new_salt,
         "owner_token_rotated_at": firestore.SERVER_TIMESTAMP,
     }, merge=True)
-    token = make_owner_token(pot_id)
+    _token_salt_cache.set(pot_id, new_salt)
+    token = make_owner_token(pot_id, new_salt)
     manage_url = f"{FRONTEND_BASE_URL}/manage?pot={pot_id}&key={token}"
-    db.collection("owner_links").document(pot_id).set({
+    get_db().collection("owner_links").document(pot_id).set({
         "manage_url": manage_url,
         "rotatedAt": firestore.SERVER_TIMESTAMP,
     }, merge=True)
     return {"ok": True, "manage_url": manage_url}
 
 # ------------------ Webhook ------------------
-@app.post("/webhook")
-async def webhook(request: Request):
-    payload = await request.body()
-    sig = request.headers.get("stripe-signature")
+# Event types we act on; anything else is acked without verifying or parsing.
+# Stripe serializes "type" after "data", so scan the whole body (a substring
+# search) rather than just the head. A stray match only costs a full parse.
+HANDLED_EVENT_TYPES = ("checkout.session.completed",)
+_HANDLED_EVENT_MARKERS = tuple(f'"{t}"'.encode() for t in HANDLED_EVENT_TYPES)
+
+# Stripe-Signature check done locally with a pre-keyed HMAC (copied per request)
+# instead of stripe.Webhook.construct_event; same scheme and replay window.
+WEBHOOK_TOLERANCE_SECONDS = 300
+# STRIPE_WEBHOOK_VERIFY_SDK=1 falls back to stripe.Webhook.construct_event
+WEBHOOK_VERIFY_WITH_SDK = os.getenv("STRIPE_WEBHOOK_VERIFY_SDK", "") == "1"
+_WEBHOOK_HMAC = hmac.new(WEBHOOK_SECRET.encode(), digestmod=hashlib.sha256)
+
+def _parse_stripe_signature(sig_header: Optional[str]):
+    ts, sigs = "", []
+    for part in (sig_header or "").split(","):
+        k, _, v = part.strip().partition("=")
+        if k == "t":
+            ts = v
+        elif k == "v1":
+            sigs.append(v)
+    return ts, sigs
+
+def _stripe_signature_ok(mac, ts: str, sigs: List[str]) -> bool:
+    # `mac` is a _WEBHOOK_HMAC copy already fed "{ts}." + the raw body
+    if not ts or not sigs:
+        return False
     try:
-        event = stripe.Webhook.construct_event(payload, sig, WEBHOOK_SECRET)
-    except Exception as e:
-        log.error("webhook_bad_signature", extra={"error": str(e)})
-        raise HTTPException(400, "Bad signature")
+        if int(ts) < time.time() - WEBHOOK_TOLERANCE_SECONDS:
+            return False
+    except ValueError:
+        return False
+    expected = mac.hexdigest()
+    return any(hmac.compare_digest(expected, s) for s in sigs)
 
-    etype = event.get("type")
-    obj = event.get("data",{}).get("object",{})
-    log.info("webhook_event_received", extra={"type": etype})
+# Checkout sessions this process has already applied; Stripe redeliveries of
+# them are acked without repeating the Firestore work. Cold misses still hit the
+# transaction's own ready check, so this is only a shortcut.
+_completed_sessions = TTLCache(maxsize=50_000, ttl=86400)
 
-    if etype == "checkout.session.completed":
-        session = obj
-        flow = (session.get("metadata") or {}).get("flow")
+def _handle_checkout_completed(session: dict):
+    """Apply a completed Checkout Session; raises so the webhook can 5xx and Stripe retries."""
+    from firebase_admin import firestore
+    try:
+        metadata = session.get("metadata") or {}
+        flow = metadata.get("flow")
 
         if flow == "create":
-            draft_id = (session.get("metadata") or {}).get("draft_id")
-            count = int((session.get("metadata") or {}).get("count", "1"))
+            draft_id = metadata.get("draft_id")
+            count = int(metadata.get("count", "1"))
             if draft_id:
-                draft_ref = db.collection("pot_drafts").document(draft_id)
-                draft_snap = draft_ref.get()
-                draft = draft_snap.to_dict() if draft_snap.exists else {}
-
-                pots_payload = []
-                for _ in range(max(1, count)):
-                    pot_id = db.collection("pots").document().id
-                    # create salt for owner token + owner code
-                    initial_salt = b64url_encode(secrets.token_bytes(12))
-                    code = random_owner_code()
-
-                    db.collection("pots").document(pot_id).set({
-                        **(draft or {}),
-                        "status": "active",
-                        "createdAt": utcnow(),
-                        "source": "checkout",
-                        "draft_id": draft_id,
-                        "stripe_session_id": session["id"],
-                        "amount_total": session.get("amount_total"),
-                        "currency": session.get("currency", "usd"),
-                        "owner_code_hash": hash_code(code),
-                        "owner_token_salt": initial_salt,
-                    }, merge=True)
-
-                    token = make_owner_token(pot_id)
-                    manage_url = f"{FRONTEND_BASE_URL}/manage?pot={pot_id}&key={token}"
-                    db.collection("owner_links").document(pot_id).set({
-                        "manage_url": manage_url,
-                        "createdAt": firestore.SERVER_TIMESTAMP,
-                    }, merge=True)
-
-                    now = int(time.time())
-                    pots_payload.append({
-                        "pot_id": pot_id,
-                        "manage_url": manage_url,
-                        "owner_code_plain": code,
-                        "owner_code_plain_exp": now + OWNER_CODE_TTL_SECONDS,
-                    })
-
-                # Write status doc for success page polling
-                db.collection("create_sessions").document(session["id"]).set({
-                    "ready": True,
-                    "updated_at": firestore.SERVER_TIMESTAMP,
-                    "pots": pots_payload,
-                }, merge=True)
-
-                # Clean up draft
-                draft_ref.delete()
+                draft_ref = get_db().collection("pot_drafts").document(draft_id)
+                status_ref = get_db().collection("create_sessions").document(session["id"])
+
+                # Read-check-write in one transaction: a redelivered event finds
+                # the session already ready and writes nothing, and all pot/link
+                # writes, the status doc and the draft delete land in one commit.
+                @firestore.transactional
+                def _create_pots(tx):
+                    # both reads go out as one BatchGetDocuments call
+                    snaps = {snap.reference.path: snap for snap in tx.get_all([status_ref, draft_ref])}
+                    status_snap, draft_snap = snaps[status_ref.path], snaps[draft_ref.path]
+                    if status_snap.exists and (status_snap.to_dict() or {}).get("ready"):
+                        return
+                    draft = (draft_snap.to_dict() or {}) if draft_snap.exists else {}
+                    draft.pop("expireAt", None)  # the draft's TTL must not carry over to pots
+
+                    writes = []
+                    pots_payload = []
+                    # one clock read for the whole batch; Firestore stamps the rest
+                    code_exp = int(time.time()) + OWNER_CODE_TTL_SECONDS
+                    # one entropy draw for every pot's token salt (12 bytes) + owner code (5 bytes)
+                    n = max(1, count)
+                    entropy = secrets.token_bytes(17 * n)
+                    pots_col, links_col = get_db().collection("pots"), get_db().collection("owner_links")
+                    for i in range(n):
+                        pot_ref = pots_col.document()
+                        pot_id = pot_ref.id
+                        # create salt for owner token + owner code
+                        seed = entropy[17 * i:17 * (i + 1)]
+                        initial_salt = b64url_encode(seed[:12])
+                        code = owner_code_from_bytes(seed[12:])
+
+                        writes.append((pot_ref, {
+                            **(draft or {}),
+                            "status": "active",
+                            "createdAt": firestore.SERVER_TIMESTAMP,
+                            "source": "checkout",
+                            "draft_id": draft_id,
+                            "stripe_session_id": session["id"],
+                            "amount_total": session.get("amount_total"),
+                            "currency": session.get("currency", "usd"),
+                            "owner_code_hash": hash_code(code),
+                            "owner_token_salt": initial_salt,
+                        }))
+
+                        token = make_owner_token(pot_id, initial_salt)
+                        manage_url = f"{FRONTEND_BASE_URL}/manage?pot={pot_id}&key={token}"
+                        writes.append((links_col.document(pot_id), {
+                            "manage_url": manage_url,
+                            "createdAt": firestore.SERVER_TIMESTAMP,
+                        }))
+
+                        pots_payload.append({
+                            "pot_id": pot_id,
+                            "manage_url": manage_url,
+                            "owner_code_plain": code,
+                            "owner_code_plain_exp": code_exp,
+                        })
+
+                    # Write status doc for success page polling; its expiry restarts
+                    # here so the ready guard outlives redeliveries of this event
+                    writes.append((status_ref, {
+                        "ready": True,
+                        "updated_at": firestore.SERVER_TIMESTAMP,
+                        "expireAt": checkout_state_expiry(),
+                        "pots": pots_payload,
+                    }))
+
+                    # Clean up draft
+                    writes.append((draft_ref, None))
+                    _apply_writes(tx, writes)
+
+                _create_pots(get_db().transaction())
+                _ready_status_cache.pop(session["id"])
 
         elif flow == "join":
-            pot_id = (session.get("metadata") or {}).get("pot_id")
-            entry_id = (session.get("metadata") or {}).get("entry_id")
+            pot_id = metadata.get("pot_id")
+            entry_id = metadata.get("entry_id")
             if pot_id and entry_id:
-                entry_ref = db.collection("pots").document(pot_id).collection("entries").document(entry_id)
-                entry_ref.set({
-                    "paid": True,
-                    "paid_amount": session.get("amount_total"),
-                    "paid_at": utcnow(),
-                    "payment_method": "stripe",
-                    "stripe_session_id": session["id"],
-                }, merge=True)
-                db.collection("join_sessions").document(session["id"]).delete()
-
-    return JSONResponse({"received": True})
+                entry_ref = get_db().collection("pots").document(pot_id).collection("entries").document(entry_id)
+                _commit_writes([
+                    (entry_ref, {
+                        "paid": True,
+                        "paid_amount": session.get("amount_total"),
+                        "paid_at": firestore.SERVER_TIMESTAMP,
+                        "payment_method": "stripe",
+                        "stripe_session_id": session["id"],
+                    }),
+                    (get_db().collection("join_sessions").document(session["id"]), None),
+                ])
+        _completed_sessions.set(session["id"], True)
+    except Exception as e:
+        log.error("webhook_processing_error", extra={"session_id": session.get("id"), "error": str(e)})
+        raise
+
+# Webhook Firestore work gets its own small pool, so a burst of Stripe deliveries
+# can't occupy every threadpool slot the request handlers need.
+_webhook_executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="webhook")
+
+async def _handle_in_webhook_pool(session: dict):
+    await asyncio.get_running_loop().run_in_executor(_webhook_executor, _handle_checkout_completed, session)
+
+@app.post("/webhook")
+async def webhook(request: Request):
+    sig_header = request.headers.get("stripe-signature")
+    ts, sigs = _parse_stripe_signature(sig_header)
+    # feed the signature HMAC as the body streams in instead of re-reading it
+    mac = _WEBHOOK_HMAC.copy()
+    mac.update(ts.encode() + b".")
+    chunks = []
+    async for chunk in request.stream():
+        mac.update(chunk)
+        chunks.append(chunk)
+    payload = b"".join(chunks)
+    if not any(m in payload for m in _HANDLED_EVENT_MARKERS):
+        return {"received": True}
+    if WEBHOOK_VERIFY_WITH_SDK:
+        try:
+            event = _stripe().Webhook.construct_event(payload, sig_header, WEBHOOK_SECRET,
+                                                      tolerance=WEBHOOK_TOLERANCE_SECONDS)
+        except Exception as e:
+            log.error("webhook_bad_signature", extra={"error": str(e)})
+            raise HTTPException(400, "Bad signature")
+    else:
+        if not _stripe_signature_ok(mac, ts, sigs):
+            log.error("webhook_bad_signature")
+            raise HTTPException(400, "Bad signature")
+        try:
+            event = orjson.loads(payload)
+        except ValueError as e:
+            log.error("webhook_bad_payload", extra={"error": str(e)})
+            raise HTTPException(400, "Bad payload")
+
+    etype = event.get("type")
+    obj = event.get("data",{}).get("object",{})
+    log.info("webhook_event_received", extra={"type": etype})
+
+    if etype == "checkout.session.completed" and not _completed_sessions.get(obj.get("id")):
+        # Apply before acking: if Firestore fails Stripe gets a 5xx and redelivers.
+        # Both flows are idempotent, so a redelivery after a partial failure is safe.
+        try:
+            await _handle_in_webhook_pool(obj)
+        except Exception:
+            raise HTTPException(500, "Webhook processing failed")
+
+    return {"received": True}
 
 # ------------------ Create Status ------------------
+# create_sessions docs don't change once ready=True, so success-page polls after
+# that are served from memory. Not-ready docs are never cached.
+_ready_status_cache = TTLCache(maxsize=10_000, ttl=3600)
+
 @app.get("/create-status")
-def create_status(session_id: str = Query(..., description="Stripe checkout session id")):
-    doc = db.collection("create_sessions").document(session_id).get()
-    if not doc.exists:
-        # front-end will keep polling
-        raise HTTPException(404, "not-ready")
+@app.get("/create-status2")  # legacy alias, same handler
+def create_status(request: Request, response: Response,
+                  session_id: str = Query(..., description="Stripe checkout session id")):
+    data = _ready_status_cache.get(session_id)
+    if data is None:
+        doc = get_db().collection("create_sessions").document(session_id).get(field_paths=["ready", "pots", "results"])
+        if not doc.exists:
+            # front-end will keep polling
+            raise HTTPException(404, "not-ready")
+        data = doc.to_dict() or {}
+        if data.get("ready"):
+            _ready_status_cache.set(session_id, data)
 
-    data = doc.to_dict() or {}
     pots = data.get("pots") or data.get("results") or []
     now = int(time.time())
 
@@ -497,8 +807,13 @@ def create_status(session_id: str = Query(..., description="Stripe checkout sess
         cleaned.append(out)
 
     ready = bool(cleaned) and bool(data.get("ready"))
-    return {"ready": ready, "pots": cleaned, "count": len(cleaned)}
-
-@app.get("/create-status2")
-def create_status2(session_id: str = Query(...)):
-    return create_status(session_id=session_id)
+    body = {"ready": ready, "pots": cleaned, "count": len(cleaned)}
+    if ready:
+        # a ready payload only changes when an owner code's exposure window ends,
+        # so repeat polls can be answered with 304 and no body
+        etag = '"%s"' % hashlib.md5(orjson.dumps(body), usedforsecurity=False).hexdigest()[:16]
+        headers = {"ETag": etag, "Cache-Control": "private, max-age=5"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+    return body